@@ -4,7 +4,6 @@ import traceback
 import logging
 from datetime import datetime
 import pandas as pd
-from glob import glob
 
 # Set up logging in a more accessible location
 home_dir = os.path.expanduser('~')
@@ -58,39 +57,63 @@ import pytz
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext
 import asyncio
+import codecs
+import queue
+import select
 import threading
 import subprocess
-import platform
+from collections import deque
 
 from wallet_service.wallet_service import load_wallets, update_wallet_balances, save_updated_database, WORKING_DATABASE_PATH
 from calculation_service.calculation import generate_trade_confirmation
 
+# How often queued log lines are flushed into the log display, and the max per flush
+LOG_DRAIN_INTERVAL_MS = 50
+LOG_DRAIN_BATCH_SIZE = 1000
+
+# Oldest lines are dropped from the log display beyond this many lines
+LOG_MAX_LINES = 5000
+
+# Bytes requested per read from the trade process output pipe
+PIPE_READ_SIZE = 65536
+
+# Launch the default application for a file, resolved once for this platform.
+# The launcher is not waited on, so the UI never blocks while it starts up.
+if sys.platform.startswith('win32'):        # Windows
+    def launch_default_app(filepath):
+        os.startfile(filepath)
+else:
+    OPEN_COMMAND = 'open' if sys.platform.startswith('darwin') else 'xdg-open'  # macOS / Linux
+
+    def launch_default_app(filepath):
+        subprocess.Popen([OPEN_COMMAND, filepath])
+
 def open_file(filepath):
     """Open file with default application based on operating system"""
     try:
-        if platform.system() == 'Darwin':       # macOS
-            subprocess.call(('open', filepath))
-        elif platform.system() == 'Windows':     # Windows
-            os.startfile(filepath)
-        else:                                   # Linux variants
-            subprocess.call(('xdg-open', filepath))
+        launch_default_app(filepath)
     except Exception as e:
         print(f"Error opening file: {e}")
 
+def get_latest_file(directory, prefix, suffix=''):
+    """Get the most recently created file in directory matching prefix and suffix"""
+    if not os.path.isdir(directory):
+        return None
+
+    # DirEntry caches its stat result, so each file is stat'ed only once
+    with os.scandir(directory) as entries:
+        latest = max(
+            (e for e in entries if e.name.startswith(prefix) and e.name.endswith(suffix)),
+            key=lambda e: e.stat().st_ctime,
+            default=None
+        )
+    return latest.path if latest else None
+
 def get_latest_trade_confirmation_file():
     """Get the most recent trade confirmation file"""
     base_dir = os.path.dirname(WORKING_DATABASE_PATH)
     trade_conf_dir = os.path.join(base_dir, 'trade_confirmation')
-    
-    if not os.path.exists(trade_conf_dir):
-        return None
-        
-    files = [f for f in os.listdir(trade_conf_dir) if f.startswith('trade_confirmation_sheet_')]
-    if not files:
-        return None
-        
-    latest_file = max(files, key=lambda x: os.path.getctime(os.path.join(trade_conf_dir, x)))
-    return os.path.join(trade_conf_dir, latest_file)
+    return get_latest_file(trade_conf_dir, 'trade_confirmation_sheet_')
 
 class AutoTradeApp:
     def __init__(self, root):
@@ -119,6 +142,14 @@ class AutoTradeApp:
         # Add class variable for orders file path
         self.ORDERS_FILE_PATH = os.path.join(os.path.dirname(WORKING_DATABASE_PATH), 'generated_orders.csv')
 
+        # Log lines are queued from any thread and flushed to the display in batches
+        self._log_queue = queue.Queue()
+        self.root.after(LOG_DRAIN_INTERVAL_MS, self._drain_log_queue)
+
+        # One long-lived event loop runs all background work off the Tk thread
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+
     def create_wallet_section(self, parent):
         """Create wallet management section"""
         wallet_frame = ttk.LabelFrame(parent, text="Wallet Management", padding=10)
@@ -241,11 +272,8 @@ class AutoTradeApp:
             self.trade_conf_status_label.config(text="Generating trade confirmation...")
             self.trade_conf_progress.start()
             
-            # Run calculation in a separate thread
-            thread = threading.Thread(
-                target=self._run_calculation
-            )
-            thread.start()
+            # Run calculation on the background loop's thread pool
+            self._loop.call_soon_threadsafe(self._loop.run_in_executor, None, self._run_calculation)
             
         except Exception as e:
             self.trade_conf_progress.stop()
@@ -255,8 +283,6 @@ class AutoTradeApp:
     def _run_calculation(self):
         """Run calculation in background thread"""
         try:
-            # Import and run calculation
-            from calculation_service.calculation import generate_trade_confirmation
             latest_file = generate_trade_confirmation()
             
             if latest_file and self.auto_open_trade_conf_var.get():
@@ -292,15 +318,12 @@ class AutoTradeApp:
             # Enable start execution button and disable start button
             self.start_execution_button.state(['disabled'])
 
-            # Run trade.ts using npm start
+            # Run trade.ts using npm start; output is read and decoded in _monitor_execution
             process = subprocess.Popen(
                 ['npm', 'start'],
                 cwd=os.path.dirname(os.path.abspath(__file__)),
                 stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,  # Merge stderr into stdout
-                text=True,
-                bufsize=1,  # Line buffering
-                universal_newlines=True
+                stderr=subprocess.STDOUT  # Merge stderr into stdout
             )
 
             # Start a thread to monitor the process
@@ -313,24 +336,55 @@ class AutoTradeApp:
     def _monitor_execution(self, process):
         """Monitor the execution process and update UI accordingly"""
         try:
-            while True:
-                output = process.stdout.readline()
-                if output:
-                    self.root.after(0, self.update_log, output.strip())
-                if process.poll() is not None:
-                    break
-            
-            # Read any remaining output
-            stdout, stderr = process.communicate()
-            if stdout:
-                self.root.after(0, self.update_log, stdout)
-            if stderr:
-                self.root.after(0, self.update_log, f"Error: {stderr}")
-            
+            fd = process.stdout.fileno()
+            use_select = os.name != 'nt'  # select() only supports pipes on POSIX
+            if use_select:
+                os.set_blocking(fd, False)
+
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            pending = ''
+            recent_lines = deque(maxlen=20)  # Tail of the output for the error dialog
+
+            # Raw output is also kept on disk, since the log display only holds the last lines
+            execution_log_path = os.path.join(
+                log_dir, f'execution_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
+            )
+
+            # Read large chunks as they arrive and split them into lines ourselves. The log
+            # file is unbuffered so each chunk reaches disk even if the app is killed mid-trade
+            with open(execution_log_path, 'wb', buffering=0) as execution_log:
+                while True:
+                    if use_select:
+                        readable, _, _ = select.select([fd], [], [], 0.05)
+                        if not readable:
+                            continue
+                    try:
+                        chunk = os.read(fd, PIPE_READ_SIZE)
+                    except BlockingIOError:
+                        continue
+                    if not chunk:
+                        break  # EOF, the process closed its output
+
+                    execution_log.write(chunk)
+                    pending += decoder.decode(chunk)
+                    *lines, pending = pending.split('\n')
+                    for line in lines:
+                        line = line.strip()
+                        self.update_log(line)
+                        recent_lines.append(line)
+
+            pending = (pending + decoder.decode(b'', final=True)).strip()
+            if pending:
+                self.update_log(pending)
+                recent_lines.append(pending)
+
+            process.stdout.close()
+            process.wait()
+
             # Process completed
-            self.root.after(0, self._execution_complete, process.returncode, stdout, stderr)
+            self.root.after(0, self._execution_complete, process.returncode, "\n".join(recent_lines), "")
         except Exception as e:
-            self.root.after(0, self.update_log, f"Monitoring error: {str(e)}")
+            self.update_log(f"Monitoring error: {str(e)}")
             self.root.after(0, self._execution_complete, -1, "", str(e))
 
     def _execution_complete(self, return_code, stdout, stderr):
@@ -353,15 +407,15 @@ class AutoTradeApp:
         self.run_async_task("update_selected", auto_open_csv=False)
 
     def run_async_task(self, update_mode, auto_open_csv=True):
-        """Start async task in a separate thread"""
+        """Submit async task to the background event loop"""
         self.disable_buttons()
         self.progress.start()
         self.status_label.config(text="Processing...")
         
-        thread = threading.Thread(
-            target=lambda: asyncio.run(self.process_wallets(update_mode, auto_open_csv))
+        asyncio.run_coroutine_threadsafe(
+            self.process_wallets(update_mode, auto_open_csv),
+            self._loop
         )
-        thread.start()
 
     def disable_buttons(self):
         """Disable buttons during processing"""
@@ -388,7 +442,7 @@ class AutoTradeApp:
                 return
             
             self.status_label.config(text="Updating balances...")
-            updated_df = await update_wallet_balances(wallets_df)
+            updated_df, failed_wallets = await update_wallet_balances(wallets_df)
             
             self.status_label.config(text="Saving results...")
             await save_updated_database(updated_df)
@@ -396,7 +450,13 @@ class AutoTradeApp:
             # Remove delay for file opening
             if auto_open_csv:
                 self.root.after(0, lambda: open_file(WORKING_DATABASE_PATH))
-            self.root.after(0, self.on_task_complete, "Update selected wallet balances successfully!")
+            if failed_wallets:
+                # Those rows still hold balances from before, so don't report success
+                self.root.after(0, self.on_task_complete,
+                                f"Balances of {failed_wallets} wallet(s) could not be fetched and were "
+                                f"left unchanged. Check the log before generating trades.", True)
+            else:
+                self.root.after(0, self.on_task_complete, "Update selected wallet balances successfully!")
             
         except Exception as e:
             error_message = f"Error: {str(e)}"
@@ -421,41 +481,47 @@ class AutoTradeApp:
         """Open the order.csv file using the default system application"""
         order_csv_path = os.path.join(os.path.dirname(WORKING_DATABASE_PATH), 'order_table.csv')
         try:
-            if sys.platform.startswith('darwin'):  # macOS
-                subprocess.run(['open', order_csv_path])
-            elif sys.platform.startswith('win32'):  # Windows
-                os.startfile(order_csv_path)
-            else:  # Linux
-                subprocess.run(['xdg-open', order_csv_path])
+            launch_default_app(order_csv_path)
         except Exception as e:
             messagebox.showerror("Error", f"Could not open order.csv: {str(e)}")
 
     def update_log(self, message):
-        """Update the log display with new message"""
-        self.log_display.insert(tk.END, f"{message}\n")
-        self.log_display.see(tk.END)  # Auto-scroll to bottom
+        """Queue a message for the log display; safe to call from any thread"""
+        self._log_queue.put(message)
+
+    def _drain_log_queue(self):
+        """Flush queued log messages into the log display with a single insert"""
+        batch = []
+        try:
+            while len(batch) < LOG_DRAIN_BATCH_SIZE:
+                batch.append(self._log_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        if batch:
+            self.log_display.insert(tk.END, "\n".join(batch) + "\n")
+
+            # Trim the oldest lines so the widget stays bounded on long runs
+            line_count = int(self.log_display.index('end-1c').split('.')[0])
+            if line_count > LOG_MAX_LINES:
+                self.log_display.delete('1.0', f'{line_count - LOG_MAX_LINES + 1}.0')
+
+            self.log_display.see(tk.END)  # Auto-scroll to bottom
+
+        self.root.after(LOG_DRAIN_INTERVAL_MS, self._drain_log_queue)
 
     def open_latest_trade_results(self):
         """Open the latest trade_results CSV file using the default system application"""
         try:
             # Get the latest trade results file from the correct subdirectory
             results_dir = os.path.join("database", "trade_results")
-            pattern = os.path.join(results_dir, "trade_results_*.csv")
-            files = glob(pattern)
+            latest_file = get_latest_file(results_dir, "trade_results_", ".csv")
             
-            if not files:
+            if not latest_file:
                 messagebox.showwarning("Warning", "No trade results file found")
                 return
-                
-            latest_file = max(files, key=os.path.getctime)
             
-            # Open file based on platform
-            if sys.platform.startswith('darwin'):  # macOS
-                subprocess.run(['open', latest_file])
-            elif sys.platform.startswith('win32'):  # Windows
-                os.startfile(latest_file)
-            else:  # Linux
-                subprocess.run(['xdg-open', latest_file])
+            launch_default_app(latest_file)
                 
         except Exception as e:
             messagebox.showerror("Error", f"Could not open trade results file: {str(e)}")
@@ -1,15 +1,126 @@
 import os
+import sys
+import csv
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+import numpy as np
 import pandas as pd
 from datetime import datetime
 import pytz
 
+# Add the parent directory to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wallet_service.wallet_service import get_saved_database, WALLET_DTYPES
+
+# Timezone used to timestamp generated sheets
+PST = pytz.timezone('US/Pacific')
+
+# Name of the file remembering the last generated sheet and its inputs
+CACHE_FILENAME = '.cache.json'
+
+# Columns read from each input file and their types
+ORDER_DTYPES = {
+    'from_coin_address': 'string',
+    'to_coin_address': 'string',
+    'coin_amount': 'float64',
+    'slippage_pct': 'string',
+}
+# Wallet columns are typed by the wallet database schema in wallet_service
+CONFIRMATION_WALLET_COLUMNS = [
+    'wallet_alias',
+    'wallet_address',
+    'from_balance',
+    'to_balance',
+    'from_token_address',
+]
+CONFIRMATION_WALLET_DTYPES = {column: WALLET_DTYPES[column] for column in CONFIRMATION_WALLET_COLUMNS}
+
+# Columns of the generated trade confirmation sheet
+OUTPUT_COLUMNS = [
+    'wallet_alias',
+    'wallet_address',
+    'from_token_address',
+    'to_token_address',
+    'from_balance_before_execute',
+    'to_balance_before_execute',
+    'pct_of_balance',
+    'coin_amount',
+    'delay_seconds',
+    'slippage_in_pct',
+]
+
 class InsufficientBalanceError(Exception):
     """Custom exception for insufficient balance"""
     pass
 
-def generate_trade_confirmation():
+def _file_stats(paths):
+    """Return [mtime_ns, size] for each path, used as a cheap change check"""
+    stats = []
+    for path in paths:
+        stat = os.stat(path)
+        stats.append([stat.st_mtime_ns, stat.st_size])
+    return stats
+
+def _inputs_digest(paths):
+    """Return a content hash covering all input files"""
+    digest = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def _csv_values(values):
+    """Return a float array as objects with NaN blanked, so csv.writer leaves the cell empty"""
+    out = values.astype(object)
+    out[np.isnan(values)] = ''
+    return out
+
+def _load_wallet_df(wallet_path):
+    """Load the wallet database, reusing the copy saved by wallet_service if up to date"""
+    wallet_df = get_saved_database(wallet_path)
+    if wallet_df is None:
+        return pd.read_csv(wallet_path, usecols=CONFIRMATION_WALLET_COLUMNS, dtype=CONFIRMATION_WALLET_DTYPES)
+
+    print("Using saved copy of wallet database")
+    return wallet_df[CONFIRMATION_WALLET_COLUMNS].astype(CONFIRMATION_WALLET_DTYPES)
+
+def _read_cache(cache_path):
+    """Load the trade confirmation cache, returning {} if missing or corrupt"""
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_cache(cache_path, stats, digest, output_path):
+    """Remember the inputs that produced output_path, and the state it was written in"""
+    try:
+        output_stats = _file_stats([output_path])[0]
+        with open(cache_path, 'w') as f:
+            json.dump({
+                'stats': stats,
+                'digest': digest,
+                'output_path': output_path,
+                'output_stats': output_stats,
+            }, f)
+    except OSError as e:
+        print(f"Warning: Could not write trade confirmation cache: {e}")
+
+def generate_trade_confirmation(wallet_df: pd.DataFrame = None):
     """
     Generate trade confirmation sheet from wallet and order data.
+
+    If the order table and wallet database are unchanged since the last
+    run, and the previously generated sheet has not been edited since it
+    was written, that sheet is returned instead.
+
+    Args:
+        wallet_df (pd.DataFrame, optional): Wallet database to use instead of
+            reading wallet_database.csv
     
     Returns:
         str: Path to the generated CSV file
@@ -18,8 +129,7 @@ def generate_trade_confirmation():
     """
     try:
         # Get current date in PST timezone
-        pst = pytz.timezone('US/Pacific')
-        current_datetime = datetime.now(pst)
+        current_datetime = datetime.now(PST)
         date_str = current_datetime.strftime('%Y%m%d_%H%M%S')
         
         # Define file paths using calculation_service directory
@@ -41,71 +151,118 @@ def generate_trade_confirmation():
         # Read the input files
         if not os.path.exists(orders_path):
             raise FileNotFoundError(f"Order table not found: {orders_path}")
-        if not os.path.exists(wallet_path):
+        if wallet_df is None and not os.path.exists(wallet_path):
             raise FileNotFoundError(f"Wallet database not found: {wallet_path}")
-            
-        orders_df = pd.read_csv(orders_path)
-        wallet_df = pd.read_csv(wallet_path)
+
+        # Reuse the last sheet if neither input changed since it was generated
+        use_cache = wallet_df is None
+        input_paths = [orders_path, wallet_path]
+        cache_path = os.path.join(trade_conf_dir, CACHE_FILENAME)
+        cache = _read_cache(cache_path) if use_cache else {}
+        stats = _file_stats(input_paths) if use_cache else None
+        digest = None
+        cached_output = cache.get('output_path')
+        # The sheet is opened for review, so any edit to it invalidates the cache
+        if (cached_output and os.path.exists(cached_output)
+                and cache.get('output_stats') == _file_stats([cached_output])[0]):
+            if cache.get('stats') != stats:
+                digest = _inputs_digest(input_paths)
+            if digest is None or digest == cache.get('digest'):
+                if digest is not None:
+                    # Files were touched but their contents are the same
+                    _write_cache(cache_path, stats, digest, cached_output)
+                print(f"Inputs unchanged, reusing trade confirmation: {cached_output}")
+                return cached_output
+
+        # Parse both files concurrently; the C parser releases the GIL while reading
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            orders_future = executor.submit(
+                pd.read_csv, orders_path, usecols=list(ORDER_DTYPES), dtype=ORDER_DTYPES
+            )
+            if wallet_df is None:
+                wallet_future = executor.submit(_load_wallet_df, wallet_path)
+                wallet_df = wallet_future.result()
+            else:
+                wallet_df = wallet_df[CONFIRMATION_WALLET_COLUMNS].astype(CONFIRMATION_WALLET_DTYPES)
+            orders_df = orders_future.result()
         
         print(f"Processing {len(orders_df)} orders for {len(wallet_df)} wallets...")
 
         # Calculate total balance for each from_token_address
         total_balances = wallet_df.groupby('from_token_address')['from_balance'].sum()
+        order_totals = orders_df['from_coin_address'].map(total_balances)
 
-        # Create output dataframe
-        output_rows = []
-
-        for _, order in orders_df.iterrows():
-            # Get total balance for this token
-            if order['from_coin_address'] not in total_balances:
-                print(f"Warning: No balance found for token {order['from_coin_address']}")
-                continue
-                
-            total_balance = total_balances[order['from_coin_address']]
-            
-            # Validate order amount against total balance
-            if order['coin_amount'] > total_balance:
-                error_msg = (
-                    f"Order amount ({order['coin_amount']}) exceeds total balance "
-                    f"({total_balance}) for token {order['from_coin_address']}. "
-                    f"Order cannot exceed 100% of total balance."
-                )
-                raise InsufficientBalanceError(error_msg)
-            
-            # Calculate percentage (multiply by 100 to show as percentage)
-            pct_of_balance = (order['coin_amount'] / total_balance * 100)
-            
-            # Find matching wallets for this order
-            matching_wallets = wallet_df[
-                wallet_df['from_token_address'] == order['from_coin_address']
-            ]
-            
-            for _, wallet in matching_wallets.iterrows():
-                # Remove % sign from slippage if present
-                slippage = str(order['slippage_pct']).strip().replace('\r', '').replace('%', '')
-                coin_amount = round(wallet['from_balance'] * pct_of_balance / 100, 6)
-                row = {
-                    'wallet_alias': wallet['wallet_alias'],
-                    'wallet_address': wallet['wallet_address'],
-                    'from_token_address': order['from_coin_address'],
-                    'to_token_address': order['to_coin_address'],
-                    'from_balance_before_execute': wallet['from_balance'],
-                    'to_balance_before_execute': wallet['to_balance'],
-                    'pct_of_balance': f"{round(pct_of_balance, 2)}%",
-                    'coin_amount': coin_amount,
-                    'delay_seconds': '5',
-                    'slippage_in_pct': slippage,
-                }
-                output_rows.append(row)
-
-        # Create final dataframe
-        output_df = pd.DataFrame(output_rows)
-        
-        print(f"Generated {len(output_rows)} trade confirmations...")
+        # Orders without any wallet holding the from token are skipped below
+        missing_tokens = orders_df.loc[order_totals.isna(), 'from_coin_address'].unique()
+        if len(missing_tokens):
+            print(f"Warning: No balance found for token(s) {', '.join(map(str, missing_tokens))}")
+
+        # Validate order amounts against total balance
+        insufficient = orders_df['coin_amount'] > order_totals
+        if insufficient.any():
+            order = orders_df[insufficient].iloc[0]
+            error_msg = (
+                f"Order amount ({order['coin_amount']}) exceeds total balance "
+                f"({total_balances[order['from_coin_address']]}) for token {order['from_coin_address']}. "
+                f"Order cannot exceed 100% of total balance."
+            )
+            raise InsufficientBalanceError(error_msg)
 
-        # Save to CSV
-        output_df.to_csv(output_path, index=False)
+        # Calculate percentage (multiply by 100 to show as percentage)
+        orders_df['pct_of_balance'] = orders_df['coin_amount'] / order_totals * 100
+
+        # Remove % sign from slippage if present
+        orders_df['slippage_pct'] = orders_df['slippage_pct'].str.strip().str.rstrip('%')
+
+        # Split wallets by from token once, keeping each column as a contiguous array
+        wallet_groups = {
+            token: {
+                'alias': group['wallet_alias'].to_numpy(dtype=object, na_value=''),
+                'address': group['wallet_address'].to_numpy(dtype=object, na_value=''),
+                'from_balance': group['from_balance'].to_numpy(),
+                'from_balance_cells': _csv_values(group['from_balance'].to_numpy()),
+                'to_balance_cells': _csv_values(group['to_balance'].to_numpy()),
+            }
+            for token, group in wallet_df.groupby('from_token_address', sort=False)
+        }
+
+        orders = zip(
+            orders_df['from_coin_address'],
+            orders_df['to_coin_address'].fillna(''),
+            orders_df['pct_of_balance'],
+            orders_df['slippage_pct'].fillna(''),
+        )
+
+        # Stream rows straight to CSV through a large write buffer
+        generated = 0
+        with open(output_path, 'w', newline='', buffering=1 << 20) as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(OUTPUT_COLUMNS)
+            for from_token, to_token, pct_of_balance, slippage in orders:
+                wallets = wallet_groups.get(from_token)
+                if wallets is None:
+                    continue
+
+                coin_amounts = np.round(wallets['from_balance'] * pct_of_balance / 100, 6)
+                writer.writerows(zip(
+                    wallets['alias'],
+                    wallets['address'],
+                    repeat(from_token),
+                    repeat(to_token),
+                    wallets['from_balance_cells'],
+                    wallets['to_balance_cells'],
+                    repeat(f"{round(pct_of_balance, 2)}%"),
+                    _csv_values(coin_amounts),
+                    repeat('5'),
+                    repeat(slippage),
+                ))
+                generated += len(coin_amounts)
+
+        print(f"Generated {generated} trade confirmations...")
         print(f"Saved trade confirmation to: {output_path}")
+
+        if use_cache:
+            _write_cache(cache_path, stats, digest or _inputs_digest(input_paths), output_path)
         
         return output_path
 
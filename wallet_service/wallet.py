@@ -1,6 +1,9 @@
 import httpx
 import asyncio
 import os
+import random
+import orjson
+from typing import Optional
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -8,12 +11,258 @@ load_dotenv()
 # SOLANA_MAINNET_URL = os.getenv('SOLANA_MAINNET_URL')
 SOLANA_URL = os.getenv('SOLANA_RPC_URL')
 
+# SPL token program owning most token accounts, and the newer Token-2022 program
+TOKEN_PROGRAM_ID = "TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA"
+TOKEN_2022_PROGRAM_ID = "TokenzQdBNbLqP5VEhdkAS6EPFLC1PHnBqCXEpPxuEb"
+
+# Commitment level for balance queries; "confirmed" answers faster than the
+# default "finalized" and is recent enough for balance checks
+COMMITMENT = "confirmed"
+
+# Maximum number of calls packed into one JSON-RPC batch request. This is a
+# safety limit: update_wallet_balances caps concurrent wallets so its batches
+# stay well below it
+MAX_BATCH_SIZE = 100
+
+# Retry delays grow from BACKOFF_BASE seconds up to BACKOFF_CAP seconds, with full jitter
+BACKOFF_BASE = 0.1
+BACKOFF_CAP = 8.0
+
+# HTTP status codes worth retrying; other errors fail immediately
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+async def _post_with_retry(client: Optional[httpx.AsyncClient],
+                           url: str,
+                           payload,
+                           max_retries: int,
+                           backoff_factor: int):
+    """
+    Post a JSON-RPC payload with retry and backoff.
+
+    Connection errors, timeouts and the statuses in RETRY_STATUS_CODES are
+    retried after a random delay, so concurrent callers that failed together
+    do not all retry at the same moment.
+
+    Args:
+        client (httpx.AsyncClient, optional): Client to post with; a new one is
+            opened for the request if omitted
+        url (str): RPC endpoint URL
+        payload (dict or list): Single request or batch of requests
+        max_retries (int): Maximum number of retry attempts
+        backoff_factor (int): Growth factor of the maximum delay per attempt
+
+    Returns:
+        dict or list: The JSON response from the RPC endpoint
+
+    Raises:
+        httpx.HTTPStatusError: If the request fails after all retries
+    """
+    headers = {"Content-Type": "application/json"}
+    # Serialize once up front rather than on every attempt
+    content = orjson.dumps(payload)
+
+    for attempt in range(max_retries):
+        try:
+            if client is not None:
+                response = await client.post(
+                    url,
+                    content=content,
+                    headers=headers,
+                    timeout=10.0  # Add timeout
+                )
+            else:
+                async with httpx.AsyncClient() as new_client:
+                    response = await new_client.post(
+                        url,
+                        content=content,
+                        headers=headers,
+                        timeout=10.0  # Add timeout
+                    )
+            response.raise_for_status()
+            # Parse the raw bytes directly, skipping httpx's decode to str
+            return orjson.loads(response.content)
+
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code not in RETRY_STATUS_CODES:
+                raise
+
+            wait_time = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * backoff_factor ** attempt))
+            
+            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 429:
+                # Rate limit error - use server's retry-after time
+                try:
+                    wait_time += float(e.response.headers.get("Retry-After", 1))
+                except ValueError:
+                    wait_time += 1
+            
+            if attempt < max_retries - 1:
+                print(f"Request failed (attempt {attempt + 1}/{max_retries}). "
+                      f"Error: {str(e)}. Retrying in {wait_time:.2f} seconds...")
+                await asyncio.sleep(wait_time)
+            else:
+                print(f"All attempts failed. Last error: {str(e)}")
+                raise
+
+class WalletBatch:
+    def __init__(self,
+                 client: httpx.AsyncClient,
+                 url: str = SOLANA_URL,
+                 max_batch_size: int = MAX_BATCH_SIZE,
+                 max_retries: int = 3,
+                 backoff_factor: int = 2):
+        """
+        Collects RPC calls from many wallets and sends them as JSON-RPC batches.
+
+        Calls made during the same event loop iteration are posted together,
+        or as soon as max_batch_size calls are waiting. Responses are kept for
+        the life of the batch, so repeated calls with the same method and
+        params share one request. If the endpoint rejects batch requests, the
+        calls are sent one by one instead for the rest of the batch's life.
+
+        Args:
+            client (httpx.AsyncClient): Client used to post the batches
+            url (str): RPC endpoint URL
+            max_batch_size (int): Maximum number of calls per request
+            max_retries (int): Maximum number of retry attempts per batch
+            backoff_factor (int): Growth factor of the maximum retry delay
+        """
+        self.client = client
+        self.url = url
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self._pending = []
+        self._responses = {}
+        self._flush_handle = None
+        self._tasks = set()
+        self.batching_supported = True
+
+        if not self.url:
+            raise ValueError("RPC URL not found in environment variables")
+
+    async def call(self, method: str, params: list) -> dict:
+        """
+        Queue an RPC call for the next batch and wait for its response.
+
+        If the same call was already made, or is waiting in a batch, its
+        response is reused instead.
+
+        Args:
+            method (str): The RPC method to call
+            params (list): Parameters for the RPC call
+
+        Returns:
+            dict: The JSON response entry for this call
+        """
+        key = (method, orjson.dumps(params, option=orjson.OPT_SORT_KEYS))
+        future = self._responses.get(key)
+        if future is not None:
+            # Shield the shared future so a cancelled caller does not cancel it for the others
+            return await asyncio.shield(future)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._responses[key] = future
+        # Forget failed calls so they are sent again next time
+        future.add_done_callback(
+            lambda f: self._responses.pop(key, None) if f.cancelled() or f.exception() else None
+        )
+        if not self.batching_supported:
+            self._start(self._send_each([(method, params, future)]))
+            return await asyncio.shield(future)
+
+        self._pending.append((method, params, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            # Let every coroutine ready in this iteration queue its call first
+            self._flush_handle = loop.call_soon(self._flush)
+
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        """Send all queued calls as one batch"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+
+        entries, self._pending = self._pending, []
+        self._start(self._send(entries))
+
+    def _start(self, coro):
+        """Run a send in the background"""
+        task = asyncio.ensure_future(coro)
+        # Hold a reference so the task is not garbage collected mid-flight
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, entries: list):
+        """Post one batch and hand each response entry to the caller waiting on it"""
+        payload = [
+            {"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}
+            for request_id, (method, params, _) in enumerate(entries)
+        ]
+
+        try:
+            try:
+                response_data = await _post_with_retry(
+                    self.client, self.url, payload, self.max_retries, self.backoff_factor
+                )
+            except httpx.HTTPStatusError as e:
+                # Transient statuses were already retried; other client errors mean
+                # the endpoint refused the batch itself
+                if not 400 <= e.response.status_code < 500 or e.response.status_code in RETRY_STATUS_CODES:
+                    raise
+                response_data = None
+
+            if not isinstance(response_data, list):
+                # The whole batch was rejected, e.g. with a single error object
+                print("RPC endpoint does not accept batch requests, sending requests one by one")
+                self.batching_supported = False
+                await self._send_each(entries)
+                return
+
+            responses = {entry.get("id"): entry for entry in response_data}
+            for request_id, (method, _, future) in enumerate(entries):
+                if future.done():
+                    continue
+                if request_id in responses:
+                    future.set_result(responses[request_id])
+                else:
+                    future.set_exception(Exception(f"No response for {method} in batch"))
+
+        except Exception as e:
+            for _, _, future in entries:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def _send_each(self, entries: list):
+        """Post each call as its own request, for endpoints without batch support"""
+        async def send(method, params, future):
+            payload = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params}
+            try:
+                response_data = await _post_with_retry(
+                    self.client, self.url, payload, self.max_retries, self.backoff_factor
+                )
+                if not future.done():
+                    future.set_result(response_data)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+
+        await asyncio.gather(*(send(method, params, future) for method, params, future in entries))
+
 class Wallet:
     def __init__(self, 
                  address,
                  url: str = SOLANA_URL,
                  max_retries: int = 3,
-                 backoff_factor: int = 2):
+                 backoff_factor: int = 2,
+                 client: Optional[httpx.AsyncClient] = None,
+                 batch: Optional[WalletBatch] = None):
         """
         Initialize a Wallet instance.
         
@@ -21,12 +270,18 @@ class Wallet:
             address (str): Solana wallet address
             url (str): RPC endpoint URL
             max_retries (int): Maximum number of retry attempts
-            backoff_factor (int): Factor for exponential backoff
+            backoff_factor (int): Growth factor of the maximum retry delay
+            client (httpx.AsyncClient, optional): Shared client whose pooled connections
+                are reused across requests; a new client is opened per request if omitted
+            batch (WalletBatch, optional): Batch to send requests through, combining
+                them with other wallets' requests into fewer HTTP posts
         """
         self.address = address
         self.url = url
         self.max_retries = max_retries
         self.backoff_factor = backoff_factor
+        self.client = client
+        self.batch = batch
 
         if not self.url:
             raise ValueError("RPC URL not found in environment variables")
@@ -45,41 +300,18 @@ class Wallet:
         Raises:
             httpx.HTTPStatusError: If the request fails after all retries
         """
-        headers = {"Content-Type": "application/json"}
+        if self.batch is not None:
+            return await self.batch.call(method, params)
+
         payload = {
             "jsonrpc": "2.0",
             "id": 1,
             "method": method,
             "params": params,
         }
-
-        for attempt in range(self.max_retries):
-            try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(
-                        self.url,
-                        json=payload,
-                        headers=headers,
-                        timeout=10.0  # Add timeout
-                    )
-                    response.raise_for_status()
-                    return response.json()
-
-            except Exception as e:
-                wait_time = self.backoff_factor ** attempt
-                
-                if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 429:
-                    # Rate limit error - use server's retry-after time
-                    retry_after = int(e.response.headers.get("Retry-After", 1))
-                    wait_time += retry_after
-                
-                if attempt < self.max_retries - 1:
-                    print(f"Request failed (attempt {attempt + 1}/{self.max_retries}). "
-                          f"Error: {str(e)}. Retrying in {wait_time} seconds...")
-                    await asyncio.sleep(wait_time)
-                else:
-                    print(f"All attempts failed. Last error: {str(e)}")
-                    raise
+        return await _post_with_retry(
+            self.client, self.url, payload, self.max_retries, self.backoff_factor
+        )
 
     async def get_balance(self) -> float:
         """
@@ -92,7 +324,7 @@ class Wallet:
             Exception: If there's an error getting the balance
         """
         try:
-            response_data = await self._make_request('getBalance', [self.address])
+            response_data = await self._make_request('getBalance', [self.address, {"commitment": COMMITMENT}])
             
             if "error" in response_data:
                 raise Exception(f"RPC Error: {response_data['error']}")
@@ -115,40 +347,67 @@ class Wallet:
         Returns:
             dict: Token account information including balance
         """
-        retries = 3
-        for attempt in range(retries):
-            try:
-                params = [
-                    self.address,
-                    {"mint": mint_address},
-                    {"encoding": "jsonParsed"}
-                ]
-                
-                response = await self._make_request("getTokenAccountsByOwner", params)
-                
-                if "error" in response:
-                    raise Exception(f"RPC Error: {response['error']}")
-                
-                accounts = response["result"]["value"]
-                if not accounts:
-                    return {"balance": 0, "decimals": 0, "uiAmount": 0}
+        try:
+            params = [
+                self.address,
+                {"mint": mint_address},
+                {"encoding": "jsonParsed", "commitment": COMMITMENT}
+            ]
+            
+            response = await self._make_request("getTokenAccountsByOwner", params)
+            
+            if "error" in response:
+                raise Exception(f"RPC Error: {response['error']}")
+            
+            accounts = response["result"]["value"]
+            if not accounts:
+                return {"balance": 0, "decimals": 0, "uiAmount": 0}
+
+            # Get the first account (there should typically be only one per mint)
+            account = accounts[0]
+            token_data = account["account"]["data"]["parsed"]["info"]
+            
+            return {
+                "mint_address": mint_address,
+                "balance": token_data["tokenAmount"]["amount"],
+                "decimals": token_data["tokenAmount"]["decimals"],
+                "uiAmount": token_data["tokenAmount"]["uiAmount"], # already default 6 decimals
+                "uiAmountString": token_data["tokenAmount"]["uiAmountString"]
+            }
+
+        except Exception as e:
+            print(f"Error getting token balance: {e}")
+            raise
 
-                # Get the first account (there should typically be only one per mint)
-                account = accounts[0]
+    async def get_all_token_balances(self, program_id: str = TOKEN_PROGRAM_ID) -> dict:
+        """
+        Get balances of all token accounts owned by the wallet under a token program.
+
+        Args:
+            program_id (str): Token program the accounts belong to
+
+        Returns:
+            dict: uiAmountString keyed by token mint address
+        """
+        try:
+            params = [
+                self.address,
+                {"programId": program_id},
+                {"encoding": "jsonParsed", "commitment": COMMITMENT}
+            ]
+
+            response = await self._make_request("getTokenAccountsByOwner", params)
+
+            if "error" in response:
+                raise Exception(f"RPC Error: {response['error']}")
+
+            balances = {}
+            for account in response["result"]["value"]:
                 token_data = account["account"]["data"]["parsed"]["info"]
-                
-                return {
-                    "mint_address": mint_address,
-                    "balance": token_data["tokenAmount"]["amount"],
-                    "decimals": token_data["tokenAmount"]["decimals"],
-                    "uiAmount": token_data["tokenAmount"]["uiAmount"], # already default 6 decimals
-                    "uiAmountString": token_data["tokenAmount"]["uiAmountString"]
-                }
+                # Keep the first account per mint, as get_token_balance does
+                balances.setdefault(token_data["mint"], token_data["tokenAmount"]["uiAmountString"])
+            return balances
 
-            except Exception as e:
-                if attempt < retries - 1:  # Don't sleep on the last attempt
-                    print(f"Attempt {attempt + 1} failed, retrying in 5 seconds... Error: {e}")
-                    await asyncio.sleep(5)
-                else:
-                    print(f"Error getting token balance after {retries} attempts: {e}")
-                    raise
+        except Exception as e:
+            print(f"Error getting token balances: {e}")
+            raise
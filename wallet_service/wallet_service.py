@@ -1,16 +1,16 @@
 import asyncio
+import httpx
 import pandas as pd
 import numpy as np
 from pathlib import Path
-from typing import Dict, Set
+from typing import Dict, Optional, Set, Tuple
 import os
 import sys
 
 # Add the parent directory to sys.path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from wallet_service.wallet import Wallet  # Now use the full path
-from decimal import Decimal
+from wallet_service.wallet import Wallet, WalletBatch, TOKEN_PROGRAM_ID, TOKEN_2022_PROGRAM_ID  # Now use the full path
 from datetime import datetime
 
 # Configure pandas to display full precision
@@ -23,6 +23,28 @@ DATABASE_DIR = os.path.join(BASE_DIR, 'database')
 # Constants
 SOL_MINT = "So11111111111111111111111111111111111111112"
 
+# Maximum number of wallets whose balances are fetched at once. Each wallet
+# makes 1-3 RPC calls (SOL, token program, Token-2022 fallback), which
+# WalletBatch combines, so a batch carries at most 3 * RPC_CONCURRENCY calls
+RPC_CONCURRENCY = 20
+
+# Column types of the wallet database, so read_csv can skip type inference.
+# All columns are kept since the database is written back in full.
+WALLET_DTYPES = {
+    'wallet_alias': 'string',
+    'wallet_address': 'string',
+    'from_balance': 'float64',
+    'to_balance': 'float64',
+    'from_token_address': 'string',
+    'to_token_address': 'string',
+    'assign_group': 'string',
+    'selected': 'category',
+    'lastUpdatedOn': 'string',
+}
+
+# Values of the 'selected' column (case-insensitive) marking a row for update
+SELECTED_VALUES = {'yes', 'true', '1'}
+
 # file path of the initial wallet database
 INITIAL_DATABASE_PATH = os.path.join(DATABASE_DIR, 'wallet_database_initial.csv')
 
@@ -32,27 +54,93 @@ WORKING_DATABASE_PATH = os.path.join(DATABASE_DIR, 'wallet_database.csv')
 # Create database directory if it doesn't exist
 os.makedirs(DATABASE_DIR, exist_ok=True)
 
-async def get_token_or_sol_balance(wallet: Wallet, token_address: str) -> Decimal:
+# Last database written by save_updated_database as (path, csv_stat, DataFrame),
+# so readers in the same process can skip parsing the CSV again
+_last_saved_database = None
+
+def _csv_stat(path: str) -> tuple:
+    """Return (mtime_ns, size) of a file, identifying the exact CSV a copy was saved with"""
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def get_saved_database(path: str = WORKING_DATABASE_PATH) -> Optional[pd.DataFrame]:
     """
-    Get balance for either SOL or SPL token.
+    Get the wallet database last saved to path, without parsing the CSV.
+
+    Uses the frame kept in memory by this process, but only if the CSV's
+    modification time and size are exactly those recorded when it was saved.
 
     Args:
-        wallet (Wallet): Wallet instance
-        token_address (str): Token mint address or SOL_MINT
+        path (str): Path of the wallet database CSV
 
     Returns:
-        Decimal: Balance with 6 decimal places
+        pd.DataFrame: Copy of the saved database with numeric balances, or None if
+            no up-to-date copy exists
     """
     try:
-        if token_address == SOL_MINT:
-            balance = await wallet.get_balance()
-            return Decimal(str(balance)).quantize(Decimal('0.000000'))
-        else:
-            response = await wallet.get_token_balance(token_address)
-            return Decimal(response['uiAmountString']).quantize(Decimal('0.000000'))
+        csv_stat = _csv_stat(path)
+
+        saved = _last_saved_database
+        if saved is not None:
+            saved_path, saved_stat, df = saved
+            if os.path.abspath(path) == saved_path and csv_stat == saved_stat:
+                return df.copy()
     except Exception as e:
-        print(f"Error getting balance for token {token_address}: {e}")
-        return Decimal('0.000000')
+        print(f"Error reading saved database: {e}")
+    return None
+
+async def get_wallet_balances(wallet: Wallet, token_addresses: Set[str]) -> Dict[str, float]:
+    """
+    Get balances of several tokens (SOL or SPL) held by one wallet.
+
+    SPL balances come from one getTokenAccountsByOwner call for the whole wallet;
+    the Token-2022 program is only queried if a token is not found under the
+    classic token program.
+
+    Args:
+        wallet (Wallet): Wallet instance
+        token_addresses (Set[str]): Token mint addresses, may include SOL_MINT
+
+    Returns:
+        Dict[str, float]: Balance rounded to 6 decimal places keyed by token address
+
+    Raises:
+        Exception: If a balance could not be fetched, so the caller keeps the
+            previous value rather than saving a zero
+    """
+    async def get_sol_balance():
+        try:
+            return await wallet.get_balance()
+        except Exception as e:
+            print(f"Error getting balance for token {SOL_MINT}: {e}")
+            raise
+
+    async def get_spl_balances(mints):
+        token_balances = {}
+        try:
+            for program_id in (TOKEN_PROGRAM_ID, TOKEN_2022_PROGRAM_ID):
+                token_balances.update(await wallet.get_all_token_balances(program_id))
+                if mints.issubset(token_balances):
+                    break
+        except Exception as e:
+            print(f"Error getting balance for tokens {', '.join(mints)}: {e}")
+            raise
+        # Tokens without an account have a zero balance
+        return {
+            mint: round(float(token_balances.get(mint, 0)), 6)
+            for mint in mints
+        }
+
+    spl_mints = set(token_addresses) - {SOL_MINT}
+    balances = {}
+    if SOL_MINT in token_addresses and spl_mints:
+        balances[SOL_MINT], spl_balances = await asyncio.gather(get_sol_balance(), get_spl_balances(spl_mints))
+        balances.update(spl_balances)
+    elif SOL_MINT in token_addresses:
+        balances[SOL_MINT] = await get_sol_balance()
+    elif spl_mints:
+        balances.update(await get_spl_balances(spl_mints))
+    return balances
 
 async def load_wallets(
     update_mode: str = "update_all",
@@ -82,16 +170,16 @@ async def load_wallets(
             raise FileNotFoundError(f"Database file not found: {csv_path}")
 
         # Read the CSV file
-        df = pd.read_csv(csv_path)
+        df = pd.read_csv(csv_path, dtype=WALLET_DTYPES)
         total_rows = len(df)
         print(f"Loaded {total_rows} rows from database")
 
         if update_mode == "update_selected":
-            # Convert 'selected' column to string and handle NaN values
-            df['selected'] = df['selected'].fillna('').astype(str)
-            
-            # Filter for selected rows only (case-insensitive)
-            df_filtered = df[df['selected'].str.lower().isin(['yes', 'true', '1'])].copy()
+            # Filter for selected rows only (case-insensitive), checking each
+            # distinct value once rather than every row
+            selected = df['selected']
+            selected_values = [value for value in selected.cat.categories if str(value).lower() in SELECTED_VALUES]
+            df_filtered = df[selected.isin(selected_values)].copy()
             selected_rows = len(df_filtered)
             
             if selected_rows == 0:
@@ -109,55 +197,105 @@ async def load_wallets(
         print(f"Error loading database: {e}")
         raise
 
-async def update_wallet_balances(df: pd.DataFrame) -> pd.DataFrame:
+async def update_wallet_balances(df: pd.DataFrame) -> Tuple[pd.DataFrame, int]:
     """
     Update wallet balances for the provided dataframe.
 
+    Rows of wallets whose balances could not be fetched keep their previous
+    balances and lastUpdatedOn.
+
     Args:
         df (pd.DataFrame): Wallet database to process
 
     Returns:
-        pd.DataFrame: Updated wallet database with current balances
+        Tuple[pd.DataFrame, int]: Updated wallet database with current balances,
+            and the number of wallets that could not be updated
+
+    Raises:
+        Exception: If no wallet could be updated
     """
     try:
         # Initialize balance columns if they don't exist
         for col in ['from_balance', 'to_balance']:
             if col not in df.columns:
-                df[col] = None
+                df[col] = np.nan
                 
         # Initialize or ensure lastUpdatedOn column exists
         if 'lastUpdatedOn' not in df.columns:
             df['lastUpdatedOn'] = None
 
-        # Process each row
-        for index, row in df.iterrows():
-            if pd.isna(row['wallet_address']):
-                continue
+        # Limit how many wallets are fetched at once to stay within RPC rate limits
+        semaphore = asyncio.Semaphore(RPC_CONCURRENCY)
 
-            try:
-                print(f"\nProcessing wallet {row['wallet_alias']} ({row['wallet_address']})")
-                wallet = Wallet(row['wallet_address'])
-                
-                # Get from_token balance
-                if pd.notna(row['from_token_address']):
-                    from_balance = await get_token_or_sol_balance(wallet, row['from_token_address'])
-                    df.at[index, 'from_balance'] = str(from_balance)
-                    print(f"From token ({row['from_token_address']}) balance: {from_balance}")
+        async def fetch_wallet(address, rows, lookups):
+            async with semaphore:
+                wallet = Wallet(address, client=client, batch=batch)
+                balances = await get_wallet_balances(wallet, {token for _, _, token in lookups})
+            for token, balance in balances.items():
+                print(f"Wallet {address} token ({token}) balance: {balance:.6f}")
+            return rows, [(index, column, balances[token]) for index, column, token in lookups]
 
-                # Get to_token balance
-                if pd.notna(row['to_token_address']):
-                    to_balance = await get_token_or_sol_balance(wallet, row['to_token_address'])
-                    df.at[index, 'to_balance'] = str(to_balance)
-                    print(f"To token ({row['to_token_address']}) balance: {to_balance}")
-                
-                # Update timestamp with quotes to preserve format
-                df.at[index, 'lastUpdatedOn'] = f'"{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}"'
-                
-            except Exception as e:
-                print(f"Error processing wallet {row['wallet_alias']}: {e}")
+        # One client for the whole run so connections are reused across wallets;
+        # HTTP/2 lets concurrent batches share a connection to HTTPS endpoints
+        async with httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=100),
+            timeout=10.0
+        ) as client:
+            # Requests from different wallets are combined into JSON-RPC batches
+            batch = WalletBatch(client)
+
+            # Group rows and the tokens to look up by wallet, so each wallet is queried once
+            addresses = df['wallet_address'].to_numpy()
+            from_tokens = df['from_token_address'].to_numpy()
+            to_tokens = df['to_token_address'].to_numpy()
+            has_from = df['from_token_address'].notna().to_numpy()
+            has_to = df['to_token_address'].notna().to_numpy()
+            wallet_lookups = {}
+            for i in np.flatnonzero(df['wallet_address'].notna().to_numpy()):
+                rows, lookups = wallet_lookups.setdefault(addresses[i], ([], []))
+                rows.append(i)
+                if has_from[i]:
+                    lookups.append((i, 'from_balance', from_tokens[i]))
+                if has_to[i]:
+                    lookups.append((i, 'to_balance', to_tokens[i]))
+
+            print(f"\nFetching balances for {len(wallet_lookups)} wallets...")
+            results = await asyncio.gather(
+                *(fetch_wallet(address, rows, lookups) for address, (rows, lookups) in wallet_lookups.items()),
+                return_exceptions=True
+            )
+
+        # Fill in copies of the columns by row position, then assign each column once;
+        # balances stay float64 so saving needs no parsing
+        columns = {
+            'from_balance': df['from_balance'].to_numpy(dtype='float64', copy=True),
+            'to_balance': df['to_balance'].to_numpy(dtype='float64', copy=True),
+            'lastUpdatedOn': df['lastUpdatedOn'].to_numpy(dtype=object, copy=True),
+        }
+        updated_rows = []
+        failed_wallets = 0
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Error fetching balances: {result}")
+                failed_wallets += 1
                 continue
+            rows, values = result
+            updated_rows.extend(rows)
+            for i, column, balance in values:
+                columns[column][i] = balance
 
-        return df
+        # Update timestamp with quotes to preserve format
+        columns['lastUpdatedOn'][updated_rows] = f'"{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}"'
+
+        if results and failed_wallets == len(results):
+            # Nothing changed; saving would rewrite the same file and hide the failure
+            raise Exception(f"Could not fetch balances for any of the {failed_wallets} wallets")
+
+        for column, values in columns.items():
+            df[column] = values
+
+        return df, failed_wallets
 
     except Exception as e:
         print(f"Error updating balances: {e}")
@@ -168,13 +306,28 @@ async def save_updated_database(df: pd.DataFrame, output_path: str = WORKING_DAT
     Save the updated database and print a summary.
     """
     try:
-        # Convert balance columns to string format with 6 decimal places
+        # Balance columns are numeric (a no-op for frames from update_wallet_balances);
+        # to_csv writes them with 6 decimal places
         for col in ['from_balance', 'to_balance']:
-            df[col] = df[col].apply(lambda x: '{:.6f}'.format(float(x)) if pd.notna(x) else x)
+            df[col] = pd.to_numeric(df[col], errors='coerce')
 
         # Save updated database without index and quote all fields
         df.to_csv(output_path, index=False, float_format='%.6f', quoting=1)  # quoting=1 means QUOTE_ALL
         print(f"\nSaved updated database to {output_path}")
+
+        # Keep the saved frame in memory so readers can skip parsing the CSV.
+        # The CSV is already saved, so a failure here only costs the shortcut.
+        global _last_saved_database
+        try:
+            snapshot = df.copy()
+            # Hold balances exactly as written with float_format='%.6f', so readers see
+            # the same values whether they use this copy or parse the CSV
+            for col in ['from_balance', 'to_balance']:
+                snapshot[col] = np.char.mod('%.6f', snapshot[col].to_numpy()).astype('float64')
+            csv_stat = _csv_stat(output_path)
+            _last_saved_database = (os.path.abspath(output_path), csv_stat, snapshot)
+        except Exception as e:
+            print(f"Warning: Could not keep a copy of the wallet database: {e}")
         
         # Print summary
         print("\nFinal balances:")
@@ -182,9 +335,9 @@ async def save_updated_database(df: pd.DataFrame, output_path: str = WORKING_DAT
             if pd.notna(row['wallet_address']):
                 print(f"\nWallet: {row['wallet_alias']} ({row['wallet_address']})")
                 if pd.notna(row['from_token_address']):
-                    print(f"  From token ({row['from_token_address']}): {row['from_balance']}")
+                    print(f"  From token ({row['from_token_address']}): {row['from_balance']:.6f}")
                 if pd.notna(row['to_token_address']):
-                    print(f"  To token ({row['to_token_address']}): {row['to_balance']}")
+                    print(f"  To token ({row['to_token_address']}): {row['to_balance']:.6f}")
                 # Remove quotes for display
                 last_updated = row['lastUpdatedOn'].strip('"') if isinstance(row['lastUpdatedOn'], str) else row['lastUpdatedOn']
                 print(f"  Last updated: {last_updated}")
@@ -202,7 +355,9 @@ async def main():
         # wallets_df = await load_wallets(update_mode="update_all", csv_path="custom/path.csv")
         
         # Update balances
-        updated_df = await update_wallet_balances(wallets_df)
+        updated_df, failed_wallets = await update_wallet_balances(wallets_df)
+        if failed_wallets:
+            print(f"Warning: {failed_wallets} wallets could not be updated")
         
         # Save and print results
         await save_updated_database(updated_df)